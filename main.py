@@ -1,12 +1,14 @@
 import asyncio
-import json
+import contextlib
 import logging
 import os
-from typing import Dict, Optional, Tuple
+from dataclasses import dataclass
+from decimal import Decimal, InvalidOperation
+from typing import Dict, List, Optional, Tuple
 from urllib.parse import quote
 
 import aiofiles
-from dotenv import load_dotenv
+import orjson
 from telegram import (
     Update,
     InlineKeyboardButton,
@@ -22,88 +24,294 @@ from telegram.ext import (
     filters
 )
 
-load_dotenv()
-
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
+MENU_BUY_STARS = "⭐ Купить Звезды"
+MENU_PARTNER_PROGRAM = "👥 Реферальная система"
+
+MAIN_MENU_TEXT = "Главное меню:"
+MAIN_MENU_KB = ReplyKeyboardMarkup(
+    [[MENU_BUY_STARS], [MENU_PARTNER_PROGRAM]], resize_keyboard=True
+)
+PURPOSE_TEXT = "🎁 Кому купить звёзды:"
+PURPOSE_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Для себя", callback_data="purpose_self")],
+    [InlineKeyboardButton("В подарок", callback_data="purpose_friend")],
+])
+PARTNER_TEXT_TMPL = (
+    "<b>👥 Реферальная система</b>\n"
+    "✨ Зарабатывайте 10% от расходов приглашённых!\n\n"
+    "<b>🔗 Ваша ссылка:</b>\n<code>{link}</code>\n\n"
+    "👥 Рефералов: <b>{ref}</b>\n"
+    "💸 Заработано: <b>{earned:.2f} RUB</b>"
+)
+
+
+@dataclass(slots=True)
+class UserRec:
+    username: str
+    referrals: int = 0
+    total_earned: float = 0.0
+    balance_stars: int = 0
+    referred_by: Optional[int] = None
+    # Номер последней записи журнала, уже учтённой в этой записи.
+    seq: int = 0
+
+    @classmethod
+    def from_dict(cls, info: dict) -> "UserRec":
+        return cls(
+            username=info.get("username") or "",
+            referrals=info.get("referrals", 0),
+            total_earned=info.get("total_earned", 0.0),
+            balance_stars=info.get("balance_stars", 0),
+            referred_by=info.get("referred_by"),
+            seq=info.get("seq", 0),
+        )
+
 
 class UserDataManager:
     def __init__(
         self, filename: str = "user_data.json", bot_username: str = ""
     ) -> None:
         self._filename = filename
+        self._journal_filename = os.path.splitext(filename)[0] + ".log"
         self._bot_username = bot_username
+        self._link_cache: Dict[int, str] = {}
         self._file_lock = asyncio.Lock()
+        self._journal_file = None
+        self._journal_offset: Optional[int] = None
+        self._seq = 0
+        self._cache: Optional[Dict[str, UserRec]] = None
+        self._username_index: Dict[str, str] = {}
+        self._dirty = False
+        self._flush_interval = 60.0
+
+    @property
+    def bot_username(self) -> str:
+        return self._bot_username
+
+    @bot_username.setter
+    def bot_username(self, value: str) -> None:
+        self._bot_username = value
+        self._link_cache.clear()
+
+    async def load_data(self) -> Dict[str, UserRec]:
+        if self._cache is not None:
+            return self._cache
+        try:
+            async with aiofiles.open(self._filename, mode="rb") as file:
+                contents = await file.read()
+            snapshot = orjson.loads(contents)
+            data = {
+                user_id: UserRec.from_dict(user_info)
+                for user_id, user_info in snapshot.items()
+            }
+        except FileNotFoundError:
+            data = {}
+        except orjson.JSONDecodeError:
+            logger.error(f"Ошибка декодирования JSON: {self._filename}")
+            data = {}
+        records, journal_offset = await self._read_journal()
+        if self._cache is not None:
+            return self._cache
+        self._cache = data
+        # Хвост журнала после последней целой строки отрезается при открытии.
+        self._journal_offset = journal_offset
+        self._seq = max((user_rec.seq for user_rec in self._cache.values()), default=0)
+        self._username_index = {}
+        for user_id, user_rec in self._cache.items():
+            self._username_index.setdefault(user_rec.username.lower(), user_id)
+        for record in records:
+            self._seq = max(self._seq, record.get("seq", 0))
+            self._apply_record(record)
+        return self._cache
+
+    async def save_data(self, data: Dict[str, UserRec]) -> None:
+        self._cache = data
+        tmp_filename = self._filename + ".tmp"
+        async with self._file_lock:
+            payload = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+            async with aiofiles.open(tmp_filename, mode="wb") as file:
+                await file.write(payload)
+            await asyncio.to_thread(os.replace, tmp_filename, self._filename)
+            # Снимок уже содержит все изменения из журнала. Если процесс упадёт
+            # до усечения, при повторном применении записи отсечёт UserRec.seq.
+            if self._journal_file is not None:
+                await self._journal_file.close()
+                self._journal_file = None
+            self._journal_file = await aiofiles.open(self._journal_filename, mode="wb")
+            self._journal_offset = 0
+
+    async def debug_dump(self) -> str:
+        dump_filename = os.path.splitext(self._filename)[0] + ".dump.json"
+        payload = orjson.dumps(
+            self._cache or {}, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+        )
+        async with aiofiles.open(dump_filename, mode="wb") as file:
+            await file.write(payload)
+        return dump_filename
+
+    async def flush(self) -> None:
+        if not self._dirty or self._cache is None:
+            return
+        self._dirty = False
+        try:
+            await self.save_data(self._cache)
+        except OSError as e:
+            self._dirty = True
+            logger.error(f"Ошибка сохранения данных в {self._filename}: {e}")
+        except BaseException:
+            self._dirty = True
+            raise
+
+    async def run_flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception(f"Ошибка фоновой записи данных в {self._filename}")
+
+    async def close(self) -> None:
+        await self.flush()
+        if self._journal_file is not None:
+            await self._journal_file.close()
+            self._journal_file = None
+
+    async def _read_journal(self) -> Tuple[List[dict], Optional[int]]:
+        try:
+            async with aiofiles.open(self._journal_filename, mode="rb") as file:
+                contents = await file.read()
+        except FileNotFoundError:
+            return [], None
+        records = []
+        offset = 0
+        *lines, tail = contents.split(b"\n")
+        for line in lines:
+            if line:
+                try:
+                    records.append(orjson.loads(line))
+                except orjson.JSONDecodeError:
+                    logger.warning(f"Повреждённая запись журнала пропущена: {self._journal_filename}")
+                    break
+            offset += len(line) + 1
+        else:
+            if tail:
+                logger.warning(f"Недописанная запись журнала пропущена: {self._journal_filename}")
+        return records, offset
 
-    async def load_data(self) -> Dict[str, dict]:
+    async def _journal(self, record: dict) -> None:
         async with self._file_lock:
+            self._seq += 1
+            record["seq"] = self._seq
+            line = orjson.dumps(record) + b"\n"
+            if self._journal_file is None:
+                await self._open_journal()
             try:
-                async with aiofiles.open(self._filename, mode="r", encoding="utf-8") as file:
-                    contents = await file.read()
-                    return json.loads(contents)
+                await self._journal_file.write(line)
+                await self._journal_file.flush()
+            except OSError:
+                # Недописанную строку отрежет _open_journal перед следующей записью.
+                try:
+                    await self._journal_file.close()
+                except OSError:
+                    pass
+                self._journal_file = None
+                raise
+            self._journal_offset += len(line)
+            self._apply_record(record)
+
+    async def _open_journal(self) -> None:
+        if self._journal_offset is not None:
+            try:
+                await asyncio.to_thread(
+                    os.truncate, self._journal_filename, self._journal_offset
+                )
             except FileNotFoundError:
-                return {}
-            except json.JSONDecodeError:
-                logger.error(f"Ошибка декодирования JSON: {self._filename}")
-                return {}
+                self._journal_offset = None
+        self._journal_file = await aiofiles.open(self._journal_filename, mode="ab")
+        self._journal_offset = await self._journal_file.tell()
+
+    def _apply_record(self, record: dict) -> None:
+        op = record.get("op")
+        user_key = record.get("uid")
+        # Записи старого журнала без seq применяются без проверки.
+        seq = record.get("seq")
+        if op == "new":
+            if user_key in self._cache:
+                return
+            user_rec = UserRec.from_dict(record["user"])
+            user_rec.seq = seq or 0
+            self._cache[user_key] = user_rec
+            self._username_index.setdefault(user_rec.username.lower(), user_key)
+            referrer_key = str(user_rec.referred_by)
+            if referrer_key != user_key and referrer_key in self._cache:
+                referrer = self._cache[referrer_key]
+                referrer.referrals += 1
+                referrer.seq = max(referrer.seq, seq or 0)
+        elif op == "bal" and user_key in self._cache:
+            user_rec = self._cache[user_key]
+            if seq is not None:
+                if seq <= user_rec.seq:
+                    return
+                user_rec.seq = seq
+            user_rec.balance_stars += record["d"]
+        else:
+            logger.warning(f"Неизвестная запись журнала: {record}")
+            return
+        self._dirty = True
 
-    async def save_data(self, data: Dict[str, dict]) -> None:
-        async with self._file_lock:
-            async with aiofiles.open(self._filename, mode="w", encoding="utf-8") as file:
-                json_str = json.dumps(data, indent=4, ensure_ascii=False)
-                await file.write(json_str)
+    def peek_user(self, user_id: int) -> Optional[UserRec]:
+        return (self._cache or {}).get(str(user_id))
 
-    async def get_or_create_user(
-        self, user_id: int, username: str, referred_by: Optional[int] = None
-    ) -> Dict[str, dict]:
+    async def register_with_referral(
+        self, user_id: int, username: str, referrer_id: Optional[int] = None
+    ) -> UserRec:
         data = await self.load_data()
         user_key = str(user_id)
         if user_key not in data:
-            data[user_key] = {
-                "username": username,
-                "referrals": 0,
-                "total_earned": 0.0,
-                "balance_stars": 0,
-                "referred_by": referred_by,
-            }
-            await self.save_data(data)
+            # Одна запись журнала создаёт пользователя и засчитывает реферала.
+            await self._journal({
+                "op": "new",
+                "uid": user_key,
+                "user": {"username": username, "referred_by": referrer_id},
+            })
         return data[user_key]
 
     async def add_user_balance(self, user_id: int, amount: int) -> None:
         data = await self.load_data()
         user_key = str(user_id)
         if user_key in data:
-            data[user_key].setdefault("balance_stars", 0)
-            data[user_key]["balance_stars"] += amount
-            await self.save_data(data)
+            await self._journal({"op": "bal", "uid": user_key, "d": amount})
             logger.info(f"Баланс пользователя {user_id} пополнен на {amount} звёзд.")
 
-    async def get_user_stats(self, user_id: int) -> Tuple[int, float]:
-        data = await self.load_data()
-        user_key = str(user_id)
-        if user_key in data:
-            user = data[user_key]
-            return user.get("referrals", 0), user.get("total_earned", 0.0)
+    def get_user_stats(self, user_id: int) -> Tuple[int, float]:
+        user = self.peek_user(user_id)
+        if user is not None:
+            return user.referrals, user.total_earned
         return 0, 0.0
 
     def generate_referral_link(self, user_id: int) -> str:
-        return f"https://t.me/{self._bot_username}?start=r{user_id}"
+        link = self._link_cache.get(user_id)
+        if link is None:
+            link = f"https://t.me/{self._bot_username}?start=r{user_id}"
+            self._link_cache[user_id] = link
+        return link
 
-    async def find_user_by_username(self, username: str) -> Optional[str]:
-        data = await self.load_data()
-        username_lower = username.lower()
-        for user_id, user_info in data.items():
-            if user_info.get("username", "").lower() == username_lower:
-                return user_id
-        return None
+    def find_user_by_username(self, username: str) -> Optional[str]:
+        return self._username_index.get(username.lower())
 
 
 class TelegramBotApp:
     def __init__(self) -> None:
+        if not os.getenv("BOT_TOKEN"):
+            from dotenv import load_dotenv
+            load_dotenv()
+
         token = os.getenv("BOT_TOKEN")
         wallet = os.getenv("YOOMONEY_WALLET")
         admin_chat_id = os.getenv("ADMIN_CHAT_ID")
@@ -111,31 +319,71 @@ class TelegramBotApp:
         support_username = os.getenv("SUPPORT_USERNAME")
         bot_username_from_env = os.getenv("BOT_USERNAME_FOR_LINK")
 
-        if not all([token, wallet, admin_chat_id, star_rate_str, support_username, bot_username_from_env]): # <--- Добавлена проверка
+        if not all([token, wallet, admin_chat_id, star_rate_str, support_username]):
             raise ValueError(
-                "Одна из переменных окружения не задана: BOT_TOKEN, YOOMONEY_WALLET, ADMIN_CHAT_ID, STAR_RATE, SUPPORT_USERNAME, BOT_USERNAME_FOR_LINK"
+                "Одна из переменных окружения не задана: BOT_TOKEN, YOOMONEY_WALLET, ADMIN_CHAT_ID, STAR_RATE, SUPPORT_USERNAME"
             )
 
         try:
-            self._star_rate = float(star_rate_str)
-        except ValueError:
+            star_rate_kop = Decimal(star_rate_str) * 100
+            if not star_rate_kop.is_finite():
+                raise ValueError(star_rate_str)
+            self._rate_num, self._rate_den = star_rate_kop.as_integer_ratio()
+        except (InvalidOperation, ValueError):
             raise ValueError("Переменная STAR_RATE должна быть числом (например, 1 звезда = 1.3 рубля)")
 
         self._token = token
         self._wallet = wallet
+        self._pay_url_template = (
+            f"https://yoomoney.ru/to/{quote(self._wallet, safe='')}"
+            "?amount={price}&comment={comment}"
+        )
         self._admin_chat_id = int(admin_chat_id)
         self._support_username = support_username.lstrip('@')
-        self._user_data_manager = UserDataManager(bot_username=bot_username_from_env)
-        self._application = Application.builder().token(self._token).build()
+        self._user_data_manager = UserDataManager(bot_username=bot_username_from_env or "")
+        self._flush_task: Optional[asyncio.Task] = None
+        self._application = (
+            Application.builder()
+            .token(self._token)
+            .connection_pool_size(32)
+            .pool_timeout(5.0)
+            .connect_timeout(3.0)
+            .read_timeout(5.0)
+            .post_init(self._post_init)
+            .post_shutdown(self._post_shutdown)
+            .build()
+        )
+
+        self._text_dispatch = {
+            MENU_BUY_STARS: self._show_purchase_options,
+            MENU_PARTNER_PROGRAM: self._partner_program,
+        }
 
         self._register_handlers()
 
+    async def _post_init(self, application: Application) -> None:
+        if not self._user_data_manager.bot_username:
+            # Application.initialize() уже один раз вызвал get_me().
+            self._user_data_manager.bot_username = application.bot.username
+        await self._user_data_manager.load_data()
+        self._flush_task = asyncio.create_task(self._user_data_manager.run_flush_loop())
+
+    async def _post_shutdown(self, application: Application) -> None:
+        if self._flush_task:
+            self._flush_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._flush_task
+        await self._user_data_manager.close()
+
     def _register_handlers(self) -> None:
         self._application.add_handler(CommandHandler("start", self._start))
         self._application.add_handler(CommandHandler("menu", self._set_menu))
+        self._application.add_handler(
+            CommandHandler("dump", self._dump, filters=filters.Chat(self._admin_chat_id))
+        )
         self._application.add_handler(CallbackQueryHandler(self._purpose_handler, pattern="^purpose_"))
         self._application.add_handler(CallbackQueryHandler(self._payment_confirm_handler, pattern="^confirm_payment"))
-        self._application.add_handler(CallbackQueryHandler(self._admin_action_handler, pattern="^admin_"))
+        self._application.add_handler(CallbackQueryHandler(self._admin_action_handler, pattern=r"^admin[|_]"))
         self._application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self._handle_text_input))
 
     async def _start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -150,9 +398,10 @@ class TelegramBotApp:
             except (ValueError, IndexError):
                 referred_by = None
         
-        await self._user_data_manager.get_or_create_user(
-            user.id, user.username or user.first_name, referred_by
-        )
+        if self._user_data_manager.peek_user(user.id) is None:
+            await self._user_data_manager.register_with_referral(
+                user.id, user.username or user.first_name, referred_by
+            )
         
         await self._set_menu(update, context)
 
@@ -170,7 +419,8 @@ class TelegramBotApp:
             return
 
         user_id = update.effective_user.id
-        price_rub = max(2, round(amount * self._star_rate, 2))
+        price_kop = max(200, (2 * amount * self._rate_num + self._rate_den) // (2 * self._rate_den))
+        price_rub = f"{price_kop // 100}.{price_kop % 100:02d}"
         comment = f"Stars_{amount}_uid{user_id}"
 
         context.user_data["payment_amount"] = amount
@@ -178,8 +428,7 @@ class TelegramBotApp:
         context.user_data["payment_comment"] = comment
         context.user_data.pop("awaiting_amount", None)
 
-        encoded_comment = quote(comment)
-        url = f"https://yoomoney.ru/to/{self._wallet}?amount={price_rub}&comment={encoded_comment}"
+        url = self._pay_url_template.format(price=price_rub, comment=quote(comment, safe=""))
         keyboard = [
             [InlineKeyboardButton("Оплатить через YooMoney (СБП)", url=url)],
             [InlineKeyboardButton("✅ Я оплатил", callback_data="confirm_payment")]
@@ -220,10 +469,10 @@ class TelegramBotApp:
         )
 
         if friend_username:
-            callback_data_confirm = f"admin_confirm_gift_{user.id}_{amount}_{friend_username}"
+            callback_data_confirm = self._encode_admin("confirm", "gift", user.id, amount, friend_username)
         else:
-            callback_data_confirm = f"admin_confirm_self_{user.id}_{amount}"
-        callback_data_decline = f"admin_decline_{user.id}"
+            callback_data_confirm = self._encode_admin("confirm", "self", user.id, amount)
+        callback_data_decline = self._encode_admin("decline", "", user.id)
         
         admin_keyboard = [
             [
@@ -238,17 +487,40 @@ class TelegramBotApp:
             parse_mode="Markdown"
         )
         
+    @staticmethod
+    def _encode_admin(
+        action: str, op: str, user_id: int, amount: int = 0, extra: str = ""
+    ) -> str:
+        return f"admin|{action}|{op}|{user_id}|{amount}|{extra}"
+
+    @staticmethod
+    def _decode_admin(data: str) -> Optional[Tuple[str, str, int, int, str]]:
+        try:
+            if data.startswith("admin|"):
+                _, action, op, user_id, amount, extra = data.split("|", 5)
+            elif data.startswith("admin_decline_"):
+                # Старый формат кнопок, отправленных до перехода на "|".
+                _, action, user_id = data.split("_", 2)
+                op, amount, extra = "", "0", ""
+            else:
+                # Username в конце может содержать "_", поэтому maxsplit.
+                _, action, op, user_id, amount, *rest = data.split("_", 5)
+                extra = rest[0] if rest else ""
+            return action, op, int(user_id), int(amount), extra
+        except ValueError:
+            return None
+
     async def _admin_action_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         query = update.callback_query
         await query.answer()
-        parts = query.data.split("_")
-        action_type = parts[1]
+        decoded = self._decode_admin(query.data)
+        if decoded is None:
+            logger.warning(f"Некорректные данные кнопки администратора: {query.data}")
+            return
+        action_type, op_type, user_id, amount, extra = decoded
         original_message = query.message.text
         if action_type == "confirm":
-            op_type = parts[2]
             if op_type == "self":
-                user_id = int(parts[3])
-                amount = int(parts[4])
                 await self._user_data_manager.add_user_balance(user_id, amount)
                 await context.bot.send_message(
                     chat_id=user_id, text=f"✅ Ваш баланс успешно пополнен на {amount} ⭐️!"
@@ -258,8 +530,8 @@ class TelegramBotApp:
                     parse_mode="Markdown",
                 )
             elif op_type == "gift":
-                payer_id, amount, recipient_username = int(parts[3]), int(parts[4]), parts[5]
-                recipient_id = await self._user_data_manager.find_user_by_username(
+                payer_id, recipient_username = user_id, extra
+                recipient_id = self._user_data_manager.find_user_by_username(
                     recipient_username
                 )
                 if recipient_id:
@@ -289,7 +561,6 @@ class TelegramBotApp:
                         parse_mode="Markdown",
                     )
         elif action_type == "decline":
-            user_id = int(parts[2])
             await context.bot.send_message(
                 chat_id=user_id,
                 text=f"❗️ Ваш последний платёж был отклонён. Свяжитесь с поддержкой.\n @{self._support_username}",
@@ -319,10 +590,9 @@ class TelegramBotApp:
         if context.user_data.get("awaiting_amount"):
             await self._handle_amount_input(update, context, text)
             return
-        if text == "⭐ Купить Звезды":
-            await self._show_purchase_options(update)
-        elif text == "👥 Реферальная система":
-            await self._partner_program(update, context)
+        handler = self._text_dispatch.get(text)
+        if handler:
+            await handler(update, context)
             
     async def _handle_friend_username(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str) -> None:
         if not text.startswith("@"):
@@ -339,26 +609,14 @@ class TelegramBotApp:
             parse_mode="Markdown",
         )
 
-    async def _show_purchase_options(self, update: Update) -> None:
-        keyboard = [
-            [InlineKeyboardButton("Для себя", callback_data="purpose_self")],
-            [InlineKeyboardButton("В подарок", callback_data="purpose_friend")],
-        ]
-        await update.message.reply_text(
-            "🎁 Кому купить звёзды:", reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+    async def _show_purchase_options(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        await update.message.reply_text(PURPOSE_TEXT, reply_markup=PURPOSE_KB)
 
     async def _partner_program(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         user_id = update.effective_user.id
-        ref, earned = await self._user_data_manager.get_user_stats(user_id)
+        ref, earned = self._user_data_manager.get_user_stats(user_id)
         link = self._user_data_manager.generate_referral_link(user_id)
-        text = (
-            "<b>👥 Реферальная система</b>\n"
-            "✨ Зарабатывайте 10% от расходов приглашённых!\n\n"
-            f"<b>🔗 Ваша ссылка:</b>\n<code>{link}</code>\n\n"
-            f"👥 Рефералов: <b>{ref}</b>\n"
-            f"💸 Заработано: <b>{earned:.2f} RUB</b>"
-        )
+        text = PARTNER_TEXT_TMPL.format(link=link, ref=ref, earned=earned)
         keyboard = [
             [InlineKeyboardButton("📤 Поделиться", switch_inline_query=f"Покупайте звёзды: {link}")],
         ]
@@ -366,12 +624,12 @@ class TelegramBotApp:
             text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="HTML"
         )
 
+    async def _dump(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        dump_filename = await self._user_data_manager.debug_dump()
+        await update.message.reply_text(f"Данные пользователей сохранены в {dump_filename}")
+
     async def _set_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        keyboard = [["⭐ Купить Звезды"], ["👥 Реферальная система"]]
-        await update.message.reply_text(
-            "Главное меню:",
-            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        )
+        await update.message.reply_text(MAIN_MENU_TEXT, reply_markup=MAIN_MENU_KB)
         
     def run(self) -> None:
         logger.info("✅ Бот запущен")
@@ -0,0 +1,102 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from typing import Optional
+
+import orjson
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import UserDataManager  # noqa: E402
+
+
+class _FailingFile:
+    async def write(self, data: bytes) -> None:
+        raise OSError("disk full")
+
+    async def close(self) -> None:
+        pass
+
+
+class UserDataJournalTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self._dir = tempfile.mkdtemp()
+        self._filename = os.path.join(self._dir, "user_data.json")
+        self._journal = os.path.join(self._dir, "user_data.log")
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self._dir)
+
+    async def _reload(self, previous: Optional[UserDataManager] = None) -> UserDataManager:
+        # Имитирует аварийный перезапуск: журнал закрывается без сжатия.
+        if previous is not None and previous._journal_file is not None:
+            await previous._journal_file.close()
+        manager = UserDataManager(self._filename)
+        await manager.load_data()
+        return manager
+
+    async def test_replay_after_crash_between_replace_and_truncate(self) -> None:
+        manager = await self._reload()
+        await manager.register_with_referral(1, "alice")
+        await manager.register_with_referral(2, "bob", referrer_id=1)
+        await manager.add_user_balance(1, 100)
+        shutil.copy(self._journal, self._journal + ".bak")
+        await manager.close()
+        # Снимок записан, а журнал остался прежним.
+        shutil.copy(self._journal + ".bak", self._journal)
+
+        manager = await self._reload(manager)
+        self.assertEqual(manager.peek_user(1).balance_stars, 100)
+        self.assertEqual(manager.peek_user(1).referrals, 1)
+
+        await manager.add_user_balance(1, 5)
+        manager = await self._reload(manager)
+        self.assertEqual(manager.peek_user(1).balance_stars, 105)
+        await manager.close()
+
+    async def test_torn_tail_is_dropped_and_truncated(self) -> None:
+        manager = await self._reload()
+        await manager.register_with_referral(1, "alice")
+        await manager.add_user_balance(1, 100)
+        await manager.close()
+        with open(self._journal, "ab") as file:
+            file.write(b'{"op":"bal","uid":"1","d":')
+
+        manager = await self._reload()
+        self.assertEqual(manager.peek_user(1).balance_stars, 100)
+        await manager.add_user_balance(1, 7)
+
+        manager = await self._reload(manager)
+        self.assertEqual(manager.peek_user(1).balance_stars, 107)
+        await manager.close()
+
+    async def test_failed_write_does_not_corrupt_journal(self) -> None:
+        manager = await self._reload()
+        await manager.register_with_referral(1, "alice")
+        journal_file = manager._journal_file
+        manager._journal_file = _FailingFile()
+        with open(self._journal, "ab") as file:
+            file.write(b'{"op":"bal"')
+        with self.assertRaises(OSError):
+            await manager.add_user_balance(1, 1)
+        await journal_file.close()
+        await manager.add_user_balance(1, 2)
+
+        manager = await self._reload(manager)
+        self.assertEqual(manager.peek_user(1).balance_stars, 2)
+        await manager.close()
+
+    async def test_snapshot_stays_a_plain_user_dict(self) -> None:
+        manager = await self._reload()
+        await manager.register_with_referral(1, "alice")
+        await manager.close()
+        with open(self._filename, "rb") as file:
+            snapshot = orjson.loads(file.read())
+        self.assertEqual(list(snapshot), ["1"])
+        self.assertEqual(snapshot["1"]["username"], "alice")
+
+
+if __name__ == "__main__":
+    unittest.main()